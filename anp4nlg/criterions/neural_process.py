@@ -1,11 +1,54 @@
 
 import torch
+import torch.nn.functional as F
 import math
 from fairseq import metrics, modules, utils
 from fairseq.criterions import FairseqCriterion, register_criterion
 
 from torch.distributions.kl import kl_divergence
 
+_INV_LN2 = 1.0 / math.log(2)
+
+
+@torch.jit.script
+def kl_normal(mu_1: torch.Tensor, sigma_1: torch.Tensor,
+              mu_2: torch.Tensor, sigma_2: torch.Tensor) -> torch.Tensor:
+    """Closed form KL(N(mu_1, sigma_1) || N(mu_2, sigma_2)) per dimension."""
+    log_sigma_1 = sigma_1.log()
+    log_sigma_2 = sigma_2.log()
+    diff = mu_1 - mu_2
+    return 0.5 * (sigma_1 * sigma_1 + diff * diff) / (sigma_2 * sigma_2) \
+        + (log_sigma_2 - log_sigma_1) - 0.5
+
+
+@torch.jit.script
+def categorical_log_likelihood(logits: torch.Tensor, targets: torch.Tensor) -> torch.Tensor:
+    """Categorical log likelihood of targets given logits."""
+    # Log likelihood has shape (batch_size, num_target). Take mean
+    # over batch and sum over number of targets. The log_softmax runs in the
+    # dtype of the logits (e.g. bf16), only the gathered values are reduced in fp32
+    log_probs = F.log_softmax(logits, dim=-1)
+    return log_probs.gather(-1, targets.unsqueeze(-1)).squeeze(-1).float().sum(dim=1).mean()
+
+
+@torch.jit.script
+def np_loss(logits: torch.Tensor, targets: torch.Tensor,
+            mu_target: torch.Tensor, sigma_target: torch.Tensor,
+            mu_context: torch.Tensor, sigma_context: torch.Tensor):
+    """Log likelihood and Normal KL of the Neural Process loss in one scripted region."""
+    log_likelihood = categorical_log_likelihood(logits, targets)
+    # KL has shape (batch_size, r_dim). Take mean over batch and sum over
+    # r_dim (since r_dim is dimension of normal distribution)
+    kl = kl_normal(mu_target, sigma_target, mu_context, sigma_context).sum(dim=1).mean()
+    return log_likelihood, kl
+
+
+def _base_normal(q):
+    """Returns the Normal wrapped by q, or None if q is not (Independent) Normal."""
+    while isinstance(q, torch.distributions.Independent) and q.reinterpreted_batch_ndims == 0:
+        q = q.base_dist
+    return q if isinstance(q, torch.distributions.Normal) else None
+
 @register_criterion("neural_process")
 class NeuralProcessCriterion(FairseqCriterion):
     """
@@ -20,21 +63,23 @@ class NeuralProcessCriterion(FairseqCriterion):
         Computes Neural Process loss.
         Parameters
         ----------
-        p_y_pred : one of torch.distributions.Distribution
-            Distribution over y output by Neural Process.
+        p_y_pred : torch.Tensor
+            Logits over y output by Neural Process.
+            Shape (batch_size, num_target, vocab_size)
         y_target : torch.Tensor
-            Shape (batch_size, num_target, y_dim)
+            Shape (batch_size, num_target)
         q_target : one of torch.distributions.Distribution
             Latent distribution for target points.
         q_context : one of torch.distributions.Distribution
             Latent distribution for context points.
         """
-        # Log likelihood has shape (batch_size, num_target, y_dim). Take mean
-        # over batch and sum over number of targets and dimensions of y
-        log_likelihood = torch.distributions.Categorical(
-            logits=p_y_pred).log_prob(y_target).sum(dim=1).mean()
-        # KL has shape (batch_size, r_dim). Take mean over batch and sum over
-        # r_dim (since r_dim is dimension of normal distribution)
+        normal_target, normal_context = _base_normal(q_target), _base_normal(q_context)
+        if normal_target is not None and normal_context is not None:
+            return np_loss(p_y_pred, y_target,
+                           normal_target.loc, normal_target.scale,
+                           normal_context.loc, normal_context.scale)
+
+        log_likelihood = categorical_log_likelihood(p_y_pred, y_target)
         kl = kl_divergence(q_target, q_context).sum(dim=1).mean()
         return log_likelihood, kl
 
@@ -55,6 +100,9 @@ class NeuralProcessCriterion(FairseqCriterion):
 
         src_tokens = sample['net_input']['src_tokens']
         y_target = sample["target"]
+        # gather expects int64 indices; cast once here if targets arrive otherwise
+        if y_target.dtype != torch.long:
+            y_target = y_target.long()
 
         p_y_pred, _, q_context, q_target = model(src_tokens)
         q_target = q_context if q_target is None else q_target
@@ -64,9 +112,9 @@ class NeuralProcessCriterion(FairseqCriterion):
         loss = -ll + kl
         
         logging_output = {
-            "loss": loss,
-            "ll": -ll,
-            "kl": kl,
+            "loss": loss.detach(),
+            "ll": -ll.detach(),
+            "kl": kl.detach(),
             "ntokens": sample["ntokens"],
             "nsentences": sample["nsentences"],
             "sample_size": sample_size
@@ -76,17 +124,27 @@ class NeuralProcessCriterion(FairseqCriterion):
     @staticmethod
     def reduce_metrics(logging_outputs) -> None:
         """Aggregate logging outputs from data parallel training."""
-        loss_sum = sum(log.get("loss", 0) for log in logging_outputs)
-        ll_sum = sum(log.get("ll", 0) for log in logging_outputs)
-        kl_sum = sum(log.get("kl", 0) for log in logging_outputs)
+        # Sum each metric on its device and copy the three sums to the host at once
+        loss_sum, ll_sum, kl_sum = torch.stack([
+            torch.stack([log[k] for log in logging_outputs]).sum() for k in ("loss", "ll", "kl")
+        ]).tolist()
         sample_size = sum(log.get("sample_size", 0) for log in logging_outputs)
 
         metrics.log_scalar(
-            "loss", loss_sum / sample_size / math.log(2), sample_size, round=3
+            "loss", loss_sum / sample_size * _INV_LN2, sample_size, round=3
         )
         metrics.log_scalar(
-            "ll", ll_sum / sample_size / math.log(2), sample_size, round=3
+            "ll", ll_sum / sample_size * _INV_LN2, sample_size, round=3
         )
         metrics.log_scalar(
-            "kl", kl_sum / sample_size / math.log(2), sample_size, round=3
+            "kl", kl_sum / sample_size * _INV_LN2, sample_size, round=3
         )
+
+    @staticmethod
+    def logging_outputs_can_be_summed() -> bool:
+        """
+        Whether the logging outputs returned by `forward` can be summed
+        across workers prior to calling `reduce_metrics`. Setting this
+        to True will improve distributed training speed.
+        """
+        return True
@@ -1,9 +1,8 @@
 import torch
 import torch.nn as nn
-import numpy as np
 
+from math import prod
 from typing import Union
-from .util import ReshapeLast
 
 class Aggregator(nn.Module):
     """
@@ -47,8 +46,7 @@ class AttentionAggregator(Aggregator):
     def __init__(self, x_dim: int, r_dim: Union[int, tuple], h_dim):
         super().__init__(x_dim, r_dim)
 
-        output_shape = r_dim
-        output_size = np.prod(output_shape)
+        output_size = int(prod(self.r_dim))
 
         layers = [nn.Linear(x_dim, h_dim),
                   nn.ReLU(inplace=True),
@@ -5,6 +5,8 @@ import torch.distributions as td
 
 from fairseq.models import FairseqDecoder
 
+from .util import split_concat_input_layer
+
 class Decoder(FairseqDecoder):
     """ ## ADAPTED FROM https://github.com/EmilienDupont/neural-processes/ ##
     Maps target input x_target and samples z (encoding information about the
@@ -48,9 +50,14 @@ class Decoder(FairseqDecoder):
 class MLPDecoder(Decoder):
     def __init__(self, dictionary, x_dim: int, r_dim: int, z_dim: int, y_dim: int, h_dim: int):
         super().__init__(dictionary, x_dim, r_dim, z_dim, y_dim)
-        layers = [nn.Linear(x_dim + z_dim + r_dim, h_dim),
-                  nn.ReLU(inplace=True),
-                  nn.Linear(h_dim, h_dim),
+        # Equivalent to nn.Linear(x_dim + r_dim + z_dim, h_dim) on
+        # torch.cat((x_target, r_c, z)), without repeating r_c and z over
+        # every point and materializing the concatenated input
+        self.x_to_h = nn.Linear(x_dim, h_dim)
+        self.r_to_h = nn.Linear(r_dim, h_dim, bias=False)
+        self.z_to_h = nn.Linear(z_dim, h_dim, bias=False)
+
+        layers = [nn.Linear(h_dim, h_dim),
                   nn.ReLU(inplace=True),
                   nn.Linear(h_dim, h_dim),
                   nn.ReLU(inplace=True)]
@@ -58,23 +65,25 @@ class MLPDecoder(Decoder):
         self.xrz_to_h = nn.Sequential(*layers)
         self.h_to_dict = nn.Linear(h_dim, len(dictionary))
 
-    def forward(self, x_target: torch.Tensor, r_c: torch.Tensor, z: torch.Tensor) -> tuple:
-        batch_size, num_points, _ = x_target.size()
-        
+    def upgrade_state_dict_named(self, state_dict, name):
+        # Older checkpoints pass torch.cat((x_target, r_c, z)) through the
+        # first layer of xrz_to_h; split it into x_to_h, r_to_h and z_to_h
+        prefix = name + "." if name != "" else ""
+        split_concat_input_layer(state_dict, prefix, "xrz_to_h",
+                                 [("x_to_h", self.x_dim), ("r_to_h", self.r_dim), ("z_to_h", self.z_dim)])
+        return state_dict
 
+    def forward(self, x_target: torch.Tensor, r_c: torch.Tensor, z: torch.Tensor) -> tuple:
         # Check if sequence lengths are not equal
         if r_c.shape[1] != x_target.shape[1]:
-            # Repeat r_c, so it can be concatenated with every x. This changes shape
-            # from (batch_size, r_dim, 1) to (batch_size, num_points, r_dim)
-            r_c = r_c.unsqueeze(1).squeeze(-1).repeat(1, num_points, 1)
-
-        # Repeat z, so it can be concatenated with every x. This changes shape
-        # from (batch_size, z_dim) to (batch_size, num_points, z_dim)
-        z = z.unsqueeze(1).repeat(1, num_points, 1)
+            # Broadcast r_c over every x. This changes shape
+            # from (batch_size, r_dim, 1) to (batch_size, 1, r_dim)
+            r_c = r_c.squeeze(-1).unsqueeze(1)
 
-        # Concatenate x_target, r_c, and z and pass them through the mlp
-        inp = torch.cat((x_target, r_c, z), dim=-1)
-        out = self.xrz_to_h(inp)
+        # Project x_target, r_c, and z separately and sum them; z is projected
+        # once per sequence and broadcast over the points
+        h = self.x_to_h(x_target).add_(self.r_to_h(r_c)).add_(self.z_to_h(z).unsqueeze(1))
+        out = self.xrz_to_h(F.relu_(h))
 
         # TODO make output distr. modular
         logits = self.h_to_dict(out)
@@ -1,11 +1,12 @@
 from http.client import NON_AUTHORITATIVE_INFORMATION
 import torch
 import torch.nn as nn
-import numpy as np
+import torch.nn.functional as F
 
+from math import prod
 from typing import Union
 
-from .util import ReshapeLast
+from .util import scaled_dot_product_attention, split_concat_input_layer
 
 class Encoder(nn.Module):
     """ ## FROM https://github.com/EmilienDupont/neural-processes/ ##
@@ -41,45 +42,86 @@ class Encoder(nn.Module):
         """
         raise NotImplementedError("Abstract method.")
 
+    def upgrade_state_dict_named(self, state_dict, name):
+        """
+        Older checkpoints pass torch.cat((x, y)) through the first layer of
+        self.<mlp_name>; split it into x_to_h and y_to_h.
+        """
+        prefix = name + "." if name != "" else ""
+        split_concat_input_layer(state_dict, prefix, self.mlp_name,
+                                 [("x_to_h", self.x_dim), ("y_to_h", self.y_dim)])
+
 
 class MLPEncoder(Encoder):
+    mlp_name = "input_to_rs"
+
     def __init__(self, x_dim: int, y_dim: int, rs_dim: Union[int, tuple], h_dim: int):
         super().__init__(x_dim, y_dim, rs_dim)
         output_shape = self.rs_dim
-        output_size = np.prod(output_shape)
+        output_size = int(prod(output_shape))
 
-        
-        layers = [nn.Linear(x_dim + y_dim, h_dim),
-                  nn.ReLU(inplace=True),
-                  nn.Linear(h_dim, h_dim),
+        # Equivalent to nn.Linear(x_dim + y_dim, h_dim) on torch.cat((x, y)),
+        # without materializing the concatenated input
+        self.x_to_h = nn.Linear(x_dim, h_dim)
+        self.y_to_h = nn.Linear(y_dim, h_dim, bias=False)
+
+        layers = [nn.Linear(h_dim, h_dim),
                   nn.ReLU(inplace=True),
-                  nn.Linear(h_dim, output_size),
-                  ReshapeLast(output_shape)]
+                  nn.Linear(h_dim, output_size)]
 
         self.input_to_rs = nn.Sequential(*layers)
 
     def forward(self, x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
-        input = torch.cat((x,y), dim=2)
-        return self.input_to_rs(input)
+        h = F.relu(self.x_to_h(x) + self.y_to_h(y), inplace=True)
+        return self.input_to_rs(h).view(*h.shape[:-1], *self.rs_dim)
 
 class AttentionEncoder(Encoder):
+    mlp_name = "batch_mlp"
+
     def __init__(self, x_dim: int, y_dim: int, rs_dim: Union[int, tuple], h_dim):
         super().__init__(x_dim, y_dim, rs_dim)
-        output_size = np.prod(self.rs_dim)
+        output_size = int(prod(self.rs_dim))
         n_attn_heads = self.rs_dim[1]
 
-        layers = [nn.Linear(x_dim + y_dim, h_dim),
-                  nn.ReLU(inplace=True),
-                  nn.Linear(h_dim, h_dim),
+        self.x_to_h = nn.Linear(x_dim, h_dim)
+        self.y_to_h = nn.Linear(y_dim, h_dim, bias=False)
+
+        layers = [nn.Linear(h_dim, h_dim),
                   nn.ReLU(inplace=True),
                   nn.Linear(h_dim, output_size)]
 
         self.batch_mlp = nn.Sequential(*layers)
-        self.attn = nn.MultiheadAttention(output_size, n_attn_heads, batch_first=True)
-        self.shaper = ReshapeLast(self.rs_dim)
-        
+
+        # Multi-head self attention, equivalent to nn.MultiheadAttention
+        self.n_attn_heads = n_attn_heads
+        self.qkv = nn.Linear(output_size, 3 * output_size)
+        self.out_proj = nn.Linear(output_size, output_size)
+
+    def upgrade_state_dict_named(self, state_dict, name):
+        super().upgrade_state_dict_named(state_dict, name)
+
+        # Older checkpoints store the attention as an nn.MultiheadAttention
+        prefix = name + "." if name != "" else ""
+        renames = {"attn.in_proj_weight": "qkv.weight",
+                   "attn.in_proj_bias": "qkv.bias",
+                   "attn.out_proj.weight": "out_proj.weight",
+                   "attn.out_proj.bias": "out_proj.bias"}
+        for old, new in renames.items():
+            if prefix + old in state_dict:
+                state_dict[prefix + new] = state_dict.pop(prefix + old)
+
     def forward(self, x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
-        input = torch.cat((x,y), dim=2).squeeze(-1)
-        encoder_input = self.batch_mlp(input).squeeze(-1)
-        attn_output = self.attn(encoder_input, encoder_input, encoder_input)[0]
-        return self.shaper(attn_output)
+        # Reuse the output of each layer for its bias and ReLU, so every hidden
+        # layer is a single contiguous addmm followed by an in-place ReLU
+        h = F.relu_(self.y_to_h(y).add_(self.x_to_h(x)))
+        linear_1, _, linear_2 = self.batch_mlp
+        h = F.relu_(F.linear(h, linear_1.weight, linear_1.bias))
+        encoder_input = F.linear(h, linear_2.weight, linear_2.bias)
+
+        # Split q, k and v into heads: (batch_size, n_heads, num_points, head_dim)
+        batch_size, num_points, output_size = encoder_input.shape
+        q, k, v = (t.view(batch_size, num_points, self.n_attn_heads, -1).transpose(1, 2)
+                   for t in self.qkv(encoder_input).chunk(3, dim=-1))
+        attn_output = scaled_dot_product_attention(q, k, v)
+        attn_output = attn_output.transpose(1, 2).reshape(batch_size, num_points, output_size)
+        return self.out_proj(attn_output).view(batch_size, num_points, *self.rs_dim)
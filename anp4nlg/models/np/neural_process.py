@@ -13,7 +13,7 @@ from .aggregator import Aggregator, MeanAggregator, AttentionAggregator
 from .decoder import Decoder, MLPDecoder
 from .encoder import Encoder, MLPEncoder, AttentionEncoder
 from .latent_distribution import LatentDistribution, NormalLatentDistribution, StdNormalLatentDistribution
-from .util import context_target_split
+from .util import context_target_split, compile_module
 
 @register_model('neural_process')
 class NeuralProcess(FairseqLanguageModel):
@@ -33,6 +33,8 @@ class NeuralProcess(FairseqLanguageModel):
         parser.add_argument('--z_dim', type=int, default=128)
         parser.add_argument('--attentive', default=False, action='store_true')
         parser.add_argument('--latent_std_normal', default=False, action='store_true')
+        parser.add_argument('--compile-encoders', default=False, action='store_true',
+                            help="compile the encoders with torch.compile (requires torch >= 2.2)")
         parser.add_argument('--word-embeddings', type=str, choices=['new','fasttext', 'word2vec'], default='new',
                             help="the word embeddings to use; pretrained or new (default: new)")
     
@@ -104,6 +106,10 @@ class NeuralProcess(FairseqLanguageModel):
                 dictionary=task.dictionary
             )
 
+        if getattr(args, "compile_encoders", False):
+            compile_module(model.deterministic_encoder)
+            compile_module(model.latent_encoder)
+
         return cls(model)
 
     @property
@@ -192,7 +198,9 @@ class NeuralProcessDecoder(FairseqIncrementalDecoder):
         else:
             x = self._encode_positions(torch.cat((prev_output_tokens, torch.zeros((bsize, 1)).to(self.device)), dim=1))
             y_context = self.embedding(prev_output_tokens)
-            x_context = x[:, :-1, :]
+            # Slicing off the last position gives a non-contiguous view; copy it
+            # once here instead of in every encoder and attention projection
+            x_context = x[:, :-1, :].contiguous()
             x_target = x
 
         # x_context : torch.Tensor
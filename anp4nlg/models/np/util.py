@@ -1,5 +1,7 @@
+import math
+import torch
 import torch.nn as nn
-import numpy as np
+import torch.nn.functional as F
 
 
 def context_target_split(x, y):
@@ -21,30 +23,68 @@ def context_target_split(x, y):
     num_points = x.shape[1]
     num_context = int(0.7 * num_points)
     num_extra_target = num_points - num_context
-    # Sample locations of context and target points
-    locations = np.random.choice(num_points,
-                                 size=num_points,
-                                 replace=False)
+    # Sample locations of context and target points. These are sampled on the
+    # device of x, so indexing needs no host-to-device copy or host RNG
+    locations = torch.randperm(num_points, device=x.device)
     x_context = x[:, locations[num_context:], :]
     y_context = y[:, locations[num_context:], :]
     x_target = x[:, locations, :]
     y_target = y[:, locations, :]
     return x_context, y_context, x_target, y_target
 
-class ReshapeLast(nn.Module):
+def split_concat_input_layer(state_dict: dict, prefix: str, mlp_name: str, inputs: list):
     """
-    Helper layer to reshape the rightmost dimension of a tensor.
+    Upgrades a state_dict in which the concatenation of several inputs was
+    passed through the first layer of the nn.Sequential prefix + mlp_name.
 
-    This can be used as a component of nn.Sequential.
+    The weight of that layer is split along the input dimension into one
+    layer per input, given as (layer_name, dim) pairs; the first one gets the
+    bias. The remaining layers of the mlp are shifted down past the removed
+    linear layer and its activation.
     """
+    mlp_prefix = prefix + mlp_name + "."
+    first_name = inputs[0][0]
+    if prefix + first_name + ".weight" in state_dict or mlp_prefix + "0.weight" not in state_dict:
+        return
 
-    def __init__(self, shape: tuple):
-        """
-        shape: desired rightmost shape
-        """
-        super().__init__()
-        self._shape = shape
+    weight = state_dict.pop(mlp_prefix + "0.weight")
+    state_dict[prefix + first_name + ".bias"] = state_dict.pop(mlp_prefix + "0.bias")
+    start = 0
+    for layer_name, dim in inputs:
+        state_dict[prefix + layer_name + ".weight"] = weight[:, start:start + dim]
+        start += dim
 
-    def forward(self, input):
-        # reshapes the last dimension into self.shape
-        return input.reshape(input.shape[:-1] + self._shape)
\ No newline at end of file
+    old_keys = [k for k in state_dict if k.startswith(mlp_prefix)]
+    params = {k: state_dict.pop(k) for k in old_keys}
+    for k, v in params.items():
+        idx, param = k[len(mlp_prefix):].split(".", 1)
+        state_dict[mlp_prefix + str(int(idx) - 2) + "." + param] = v
+
+
+def compile_module(module: nn.Module) -> nn.Module:
+    """
+    Compiles a module in place with ``nn.Module.compile`` (torch >= 2.2), so
+    its layers can be fused into fewer kernels while the state_dict keys of
+    the module stay intact.
+
+    Compilation is lazy: the module is only traced and compiled on its first
+    forward, so errors of the compiler backend (e.g. a missing Triton or C++
+    toolchain) are raised there.
+    """
+    if not hasattr(module, "compile"):
+        raise RuntimeError("Compiling modules requires torch >= 2.2, found {}".format(torch.__version__))
+    module.compile(dynamic=True)
+    return module
+
+
+def scaled_dot_product_attention(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor) -> torch.Tensor:
+    """
+    Computes softmax(q k^T / sqrt(d)) v over the last two dimensions.
+
+    Uses the fused (flash / memory efficient) kernel of torch >= 2.0 when
+    available, and the explicit computation otherwise.
+    """
+    if hasattr(F, "scaled_dot_product_attention"):
+        return F.scaled_dot_product_attention(q, k, v)
+    weights = torch.softmax(q @ k.transpose(-2, -1) / math.sqrt(q.shape[-1]), dim=-1)
+    return weights @ v